@@ -0,0 +1,594 @@
+"""Headless end-to-end benchmark of a Readwise sync.
+
+Runs the add-on's sync pipeline outside of Anki: Readwise export -> flashcard
+generation -> note creation, against local stand-ins for the Readwise and
+OpenAI APIs (served with the vendored aiohttp) and an in-memory collection in
+place of `mw.col`. Syncs are started through the add-on's scheduler, with ops
+and main-thread callbacks run on threads like Anki's. Each library size runs
+twice, a first sync and a re-sync with nothing new, in its own process so
+peak RSS is per size.
+
+Needs a Python with `requests`, like the one Anki ships, e.g.
+
+    python benchmark.py --highlights 1000 10000 100000 --openai-latency 0.2 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import collections
+import dataclasses
+import functools
+import importlib
+import importlib.util
+import itertools
+import json
+import pathlib
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+ADDON_ROOT_DIR = pathlib.Path(__file__).parent.resolve()
+sys.path.append(str(ADDON_ROOT_DIR / "vendor"))
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+# The add-on is imported as a package under this name, whatever its folder is called
+PACKAGE_NAME = "smoothbrain"
+DECK_ID = 1
+
+WORDS = (
+    "memory retrieval practice spacing interval forgetting curve review card deck "
+    "question answer recall knowledge learning habit attention focus reading note "
+    "highlight book article author idea concept example evidence theory model system "
+    "process signal noise feedback loop growth compound interest time energy"
+).split()
+SOURCES = ("kindle", "reader", "instapaper", "kindle", "reader",
+           "kindle", "reader", "instapaper", "supplemental", "twitter")
+
+
+# Stand-ins for the parts of Anki the pipeline uses
+
+class NotFoundError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class AddNoteRequest:
+    note: "FakeNote"
+    deck_id: int
+
+
+class FakeNote:
+    def __init__(self):
+        self.id = 0
+        self.fields = {}
+        self.tags = []
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+
+class FakeCollection:
+    """Keeps notes in memory, supporting what the sync calls on `mw.col`."""
+    def __init__(self):
+        self.notes = {}
+        self._note_ids = itertools.count(1)
+        self._undo_entries = itertools.count(1)
+        self.models = types.SimpleNamespace(by_name=lambda name: {"name": name})
+        self.db = types.SimpleNamespace(all=self._db_all)
+
+    def _db_all(self, sql, pattern):
+        # Only the note index's query for notes with highlight tags is supported
+        prefix = pattern.strip("%")
+        return [(note.id, " ".join(note.tags)) for note in self.notes.values()
+                if any(tag.startswith(prefix) for tag in note.tags)]
+
+    def add_custom_undo_entry(self, name):
+        return next(self._undo_entries)
+
+    def merge_undo_entries(self, target):
+        return types.SimpleNamespace()
+
+    def new_note(self, model):
+        return FakeNote()
+
+    def get_note(self, note_id):
+        try:
+            return self.notes[note_id]
+        except KeyError:
+            raise NotFoundError(note_id)
+
+    def add_notes(self, requests):
+        for request in requests:
+            request.note.id = next(self._note_ids)
+            self.notes[request.note.id] = request.note
+
+    def update_notes(self, notes):
+        for note in notes:
+            self.notes[note.id] = note
+
+
+class FakeTaskManager:
+    """Anki's threads: a main thread, one worker for the collection, and a pool for the rest.
+
+    Callables for the main thread are queued until `run_main_until` runs them.
+    """
+    def __init__(self):
+        self._main_queue = queue.Queue()
+        self.collection_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="collection")
+        self.background_pool = ThreadPoolExecutor(thread_name_prefix="background")
+
+    def run_on_main(self, f):
+        self._main_queue.put(f)
+
+    def run_main_until(self, done):
+        while not done():
+            try:
+                f = self._main_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            f()
+
+    def shutdown(self):
+        self.collection_worker.shutdown()
+        self.background_pool.shutdown()
+
+
+class FakeOp:
+    """QueryOp and CollectionOp: the op runs in the background, its callbacks on the main thread.
+
+    Ops share the single collection worker unless they run without the collection.
+    """
+    def __init__(self, parent, op, success=None):
+        self._op = op
+        self._success = success
+        self._failure = None
+        self._executor = fake_mw.taskman.collection_worker
+
+    def success(self, success):
+        self._success = success
+        return self
+
+    def failure(self, failure):
+        self._failure = failure
+        return self
+
+    def without_collection(self):
+        self._executor = fake_mw.taskman.background_pool
+        return self
+
+    def _run(self):
+        try:
+            result = self._op(fake_mw.col)
+        except Exception as e:
+            if self._failure:
+                fake_mw.taskman.run_on_main(functools.partial(self._failure, e))
+            else:
+                # Anki shows an error dialog, the benchmark stops
+                fake_mw.taskman.run_on_main(functools.partial(raise_error, e))
+            return
+        if self._success:
+            fake_mw.taskman.run_on_main(lambda: self._success(result))
+
+    def run_in_background(self):
+        self._executor.submit(self._run)
+
+
+def raise_error(e: Exception):
+    raise e
+
+
+def record_warning(message, **kwargs):
+    fake_mw.warnings.append(message)
+
+
+fake_mw = types.SimpleNamespace(
+    col=FakeCollection(),
+    pm=types.SimpleNamespace(name="benchmark"),
+    taskman=FakeTaskManager(),
+    addonManager=types.SimpleNamespace(
+        addonFromModule=lambda module: "benchmark",
+        getConfig=lambda name: fake_mw.config,
+    ),
+    config={},
+    warnings=[],
+)
+
+
+def install_fake_anki():
+    """Make `import anki`/`import aqt` in the add-on resolve to the stand-ins above."""
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    module("anki")
+    module("anki.collection", AddNoteRequest=AddNoteRequest)
+    module("anki.errors", NotFoundError=NotFoundError)
+    module("aqt", mw=fake_mw, gui_hooks=types.SimpleNamespace(sync_did_finish=[]))
+    module("aqt.qt", QAction=None, QKeySequence=None)
+    module("aqt.utils", showInfo=print, showWarning=record_warning, tooltip=lambda *args, **kwargs: None,
+           qconnect=lambda signal, slot: None)
+    module("aqt.operations", QueryOp=FakeOp, CollectionOp=FakeOp)
+    module("aqt.operations.deck",
+           add_deck=lambda parent, name: FakeOp(parent, lambda col: types.SimpleNamespace(id=DECK_ID)))
+
+
+def import_addon():
+    install_fake_anki()
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME, ADDON_ROOT_DIR / "__init__.py",
+                                                  submodule_search_locations=[str(ADDON_ROOT_DIR)])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = package
+    spec.loader.exec_module(package)
+    return importlib.import_module(f"{PACKAGE_NAME}.sync")
+
+
+# Stand-ins for the APIs
+
+class FakeReadwise:
+    """The Readwise export API, generating a synthetic library page by page."""
+    def __init__(self, num_highlights: int, highlights_per_document: int, documents_per_page: int,
+                 latency: float):
+        self.num_highlights = num_highlights
+        self.highlights_per_document = highlights_per_document
+        self.documents_per_page = documents_per_page
+        self.latency = latency
+        self.num_documents = -(-num_highlights // highlights_per_document)
+        self.num_requests = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/api/v2/export/", self.export)
+        return app
+
+    def highlight(self, highlight_id: int, user_book_id: int) -> dict:
+        rng = random.Random(highlight_id)
+        text = f"{highlight_id}: " + " ".join(rng.choices(WORDS, k=rng.randint(15, 60))) + "."
+        return {
+            "id": highlight_id,
+            "external_id": None,
+            "text": text,
+            "note": "",
+            "location": highlight_id,
+            "end_location": None,
+            "location_type": "location",
+            "color": "yellow",
+            "highlighted_at": "2023-01-01T00:00:00Z",
+            "created_at": "2023-01-01T00:00:00Z",
+            "updated_at": "2023-01-01T00:00:00Z",
+            "url": None,
+            "book_id": user_book_id,
+            "tags": [],
+            "is_favorite": False,
+            "is_discard": False,
+            "readwise_url": f"https://readwise.io/open/{highlight_id}",
+        }
+
+    def document(self, i: int) -> dict:
+        user_book_id = i + 1
+        first = i * self.highlights_per_document
+        last = min(first + self.highlights_per_document, self.num_highlights)
+        return {
+            "user_book_id": user_book_id,
+            "asin": None,
+            "title": f"Book {user_book_id}",
+            "readable_title": f"Book {user_book_id}",
+            "author": "Benchmark",
+            "cover_image_url": "",
+            "source_url": None,
+            "unique_url": None,
+            "readwise_url": f"https://readwise.io/bookreview/{user_book_id}",
+            "book_tags": [],
+            "category": "books",
+            "source": SOURCES[i % len(SOURCES)],
+            "document_note": "",
+            "highlights": [self.highlight(h + 1, user_book_id) for h in range(first, last)],
+        }
+
+    async def export(self, request):
+        self.num_requests += 1
+        await asyncio.sleep(self.latency)
+        if "updatedAfter" in request.query:
+            # Nothing changed since the first sync
+            return web.json_response({"count": 0, "nextPageCursor": None, "results": []})
+        first = int(request.query.get("pageCursor", 0))
+        last = min(first + self.documents_per_page, self.num_documents)
+        return web.json_response({
+            "count": self.num_documents,
+            "nextPageCursor": str(last) if last < self.num_documents else None,
+            "results": [self.document(i) for i in range(first, last)],
+        })
+
+
+class FakeOpenAI:
+    """The OpenAI completion and embedding APIs, with latency, errors and rate limits."""
+    def __init__(self, latency: float, error_rate: float, requests_per_minute: int,
+                 embedding_dimensions: int, prompts):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests_per_minute = requests_per_minute
+        self.embedding_dimensions = embedding_dimensions
+        # The add-on's prompts module, to answer packed prompts in its format
+        self._prompts = prompts
+        self._request_times = collections.deque()
+        self._rng = random.Random(0)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_rate_limited = 0
+
+    def app(self):
+        app = web.Application()
+        for path in ("/v1/completions", "/v1/engines/{engine}/completions"):
+            app.router.add_post(path, self.completions)
+        for path in ("/v1/embeddings", "/v1/engines/{engine}/embeddings"):
+            app.router.add_post(path, self.embeddings)
+        return app
+
+    @staticmethod
+    def error_response(status: int, message: str, error_type: str, headers=None):
+        return web.json_response(
+            {"error": {"message": message, "type": error_type, "param": None, "code": None}},
+            status=status, headers=headers)
+
+    def _rate_limited(self) -> bool:
+        if not self.requests_per_minute:
+            return False
+        now = time.monotonic()
+        while self._request_times and self._request_times[0] <= now - 60:
+            self._request_times.popleft()
+        if len(self._request_times) >= self.requests_per_minute:
+            return True
+        self._request_times.append(now)
+        return False
+
+    async def _fail(self):
+        """Simulate the request's latency, returning an error response if it should fail."""
+        self.num_requests += 1
+        if self._rate_limited():
+            self.num_rate_limited += 1
+            return self.error_response(429, "Rate limit reached for requests", "requests",
+                                       headers={"Retry-After": "1"})
+        await asyncio.sleep(self.latency * self._rng.uniform(0.5, 1.5))
+        if self._rng.random() < self.error_rate:
+            self.num_errors += 1
+            return self.error_response(500, "The server had an error while processing your request.",
+                                       "server_error")
+        return None
+
+    def _completion_text(self, prompt: str) -> str:
+        if not prompt.endswith(self._prompts.PACKED_PROMPT_PRIMER):
+            return "\n\nQ: What is this highlight about?\nA: Something worth remembering."
+        # One "### n" per packed highlight, plus the primer
+        num_highlights = len(self._prompts.PACKED_CARD_RE.findall(prompt)) - 1
+        cards = [" What is highlight 1 about?\nA: Something worth remembering."]
+        cards += [f"### {i}\nQ: What is highlight {i} about?\nA: Something worth remembering."
+                  for i in range(2, num_highlights + 1)]
+        return "\n\n".join(cards)
+
+    async def completions(self, request):
+        failure = await self._fail()
+        if failure:
+            return failure
+        body = await request.json()
+        text = self._completion_text(body["prompt"])
+        return web.json_response({
+            "id": f"cmpl-{self.num_requests}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.match_info.get("engine", body.get("model")),
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": len(body["prompt"]) // 4,
+                "completion_tokens": len(text) // 4,
+                "total_tokens": (len(body["prompt"]) + len(text)) // 4,
+            },
+        })
+
+    async def embeddings(self, request):
+        failure = await self._fail()
+        if failure:
+            return failure
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(texts):
+            rng = random.Random(text)
+            embedding = [rng.gauss(0, 1) for _ in range(self.embedding_dimensions)]
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        num_tokens = sum(len(text) // 4 for text in texts)
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": request.match_info.get("engine", body.get("model")),
+            "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens},
+        })
+
+
+class ServerThread:
+    """Serves aiohttp apps from an event loop on a background thread."""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._servers = []
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def serve(self, app) -> TestServer:
+        server = TestServer(app)
+        self._run(server.start_server(loop=self.loop))
+        self._servers.append(server)
+        return server
+
+    def close(self):
+        for server in self._servers:
+            self._run(server.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def peak_rss_mb():
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_one(args, num_highlights: int) -> list[dict]:
+    """Sync a library of `num_highlights` twice, returning a result per pass."""
+    sync = import_addon()
+    prompts = importlib.import_module(f"{PACKAGE_NAME}.prompts")
+    scheduler = importlib.import_module(f"{PACKAGE_NAME}.scheduler").scheduler
+    servers = ServerThread()
+    readwise = FakeReadwise(num_highlights, args.highlights_per_document, args.documents_per_page,
+                            args.readwise_latency)
+    openai_api = FakeOpenAI(args.openai_latency, args.error_rate, args.openai_server_rpm,
+                            args.embedding_dimensions, prompts)
+    readwise_server = servers.serve(readwise.app())
+    openai_server = servers.serve(openai_api.app())
+    fake_mw.config = {
+        "deck_name": "Readwise Benchmark",
+        "readwise_api_key": "benchmark",
+        "readwise_base_url": str(readwise_server.make_url("/api/v2")),
+        "openai_api_key": "benchmark",
+        "openai_base_url": str(openai_server.make_url("/v1")),
+        "openai_max_concurrency": args.concurrency,
+        "openai_requests_per_minute": args.requests_per_minute,
+        "openai_tokens_per_minute": args.tokens_per_minute,
+        "prompt_packing": not args.no_packing,
+        "dedup_similarity_threshold": args.dedup_threshold,
+    }
+    # Keep the local state of each run out of the add-on's user_files
+    user_files_dir = pathlib.Path(tempfile.mkdtemp(prefix="smoothbrain-benchmark-"))
+    sync.HIGHLIGHT_STORE_FILE = str(user_files_dir / "readwise.sqlite3")
+    sync.COMPLETION_CACHE_FILE = str(user_files_dir / "completions.sqlite3")
+    sync.EMBEDDINGS_DIR = str(user_files_dir / "embeddings")
+    sync.NOTE_INDEX_DIR = str(user_files_dir / "note_index")
+
+    results = []
+    try:
+        for sync_pass in ("first sync", "re-sync"):
+            requests_before = readwise.num_requests + openai_api.num_requests
+            started_at = time.perf_counter()
+            # Like the menu item, then act as Anki's main thread until the sync is done
+            scheduler.request_sync("benchmark")
+            fake_mw.taskman.run_main_until(lambda: not scheduler.running)
+            wall_seconds = time.perf_counter() - started_at
+            if fake_mw.warnings:
+                raise RuntimeError(f"Sync failed: {fake_mw.warnings[-1]}")
+            num_requests = readwise.num_requests + openai_api.num_requests - requests_before
+            counters = scheduler.metrics.summary()["counters"]
+            num_cards = counters.get("notes_written", 0)
+            results.append({
+                "highlights": num_highlights,
+                "pass": sync_pass,
+                "wall_seconds": wall_seconds,
+                "requests": num_requests,
+                "requests_per_second": num_requests / wall_seconds,
+                "cards": num_cards,
+                "cards_per_second": num_cards / wall_seconds,
+                "peak_rss_mb": peak_rss_mb(),
+                "openai_errors": openai_api.num_errors,
+                "openai_rate_limited": openai_api.num_rate_limited,
+                "notes_in_collection": len(fake_mw.col.notes),
+                "counters": counters,
+            })
+    finally:
+        fake_mw.taskman.shutdown()
+        servers.close()
+        if sync.note_index:
+            sync.note_index.close()
+        shutil.rmtree(user_files_dir, ignore_errors=True)
+    return results
+
+
+COLUMNS = (
+    # (header, result key, format)
+    ("highlights", "highlights", "{}"),
+    ("pass", "pass", "{}"),
+    ("wall (s)", "wall_seconds", "{:.2f}"),
+    ("requests", "requests", "{}"),
+    ("req/s", "requests_per_second", "{:.1f}"),
+    ("cards", "cards", "{}"),
+    ("cards/s", "cards_per_second", "{:.1f}"),
+    ("RSS (MB)", "peak_rss_mb", "{:.1f}"),
+)
+COLUMN_WIDTH = 12
+
+
+def print_table(results: list[dict]):
+    print("".join(header.rjust(COLUMN_WIDTH) for header, _, _ in COLUMNS))
+    for result in results:
+        print("".join(
+            (fmt.format(result[key]) if result[key] is not None else "-").rjust(COLUMN_WIDTH)
+            for _, key, fmt in COLUMNS))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--highlights", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="library sizes to benchmark")
+    parser.add_argument("--highlights-per-document", type=int, default=20)
+    parser.add_argument("--documents-per-page", type=int, default=100,
+                        help="documents per Readwise export page")
+    parser.add_argument("--readwise-latency", type=float, default=0.05, help="seconds per export page")
+    parser.add_argument("--openai-latency", type=float, default=0.1,
+                        help="average seconds per OpenAI request")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of OpenAI requests failing with a 500")
+    parser.add_argument("--openai-server-rpm", type=int, default=0,
+                        help="requests per minute the fake OpenAI allows before answering 429 (0: no limit)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests-per-minute", type=int, default=3000,
+                        help="the add-on's own OpenAI request rate limit")
+    parser.add_argument("--tokens-per-minute", type=int, default=250000,
+                        help="the add-on's own OpenAI token rate limit")
+    parser.add_argument("--no-packing", action="store_true", help="one completion request per highlight")
+    parser.add_argument("--dedup-threshold", type=float, default=0,
+                        help="near-duplicate filtering threshold (0: off, it needs numpy)")
+    parser.add_argument("--embedding-dimensions", type=int, default=64)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON lines")
+    # Used by the parent process to run one size per child process
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.run_one:
+        print(json.dumps(run_one(args, args.run_one)))
+        return
+    results = []
+    for num_highlights in args.highlights:
+        argv = [arg for arg in sys.argv[1:] if arg != "--json"]
+        child = subprocess.run(
+            [sys.executable, __file__, *argv, "--run-one", str(num_highlights)],
+            stdout=subprocess.PIPE, check=True, text=True)
+        results.extend(json.loads(child.stdout.strip().splitlines()[-1]))
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from openai import util
+
+MODULE_NAME = __name__.split('.')[-1]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS completions_by_last_use ON completions (last_used_at);
+"""
+
+
+class CompletionCache:
+    """On-disk cache of completion responses keyed by their request parameters.
+
+    Entries older than `max_age_days` are dropped, and the least recently used
+    ones go first once the cache grows past `max_bytes`.
+    """
+    def __init__(self, path: str, max_bytes: int=64 * 1024 * 1024, max_age_days: float=180):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        # Completions run on a worker thread, so the connection is shared but
+        # only ever used by one thread at a time.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def key(params: dict) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT data FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE completions SET last_used_at = ? WHERE key = ?", (time.time(), key))
+        return util.convert_to_openai_object(json.loads(row[0]))
+
+    def put(self, key: str, response):
+        data = json.dumps(response.to_dict_recursive())
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, data, size, created_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now))
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under `max_bytes`."""
+        with self._lock, self._conn:
+            expired = self._conn.execute(
+                "DELETE FROM completions WHERE created_at < ?",
+                (time.time() - self.max_age_days * 24 * 60 * 60,)).rowcount
+            total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+            excess = total_size - self.max_bytes
+            evicted = []
+            if excess > 0:
+                for key, size in self._conn.execute(
+                        "SELECT key, size FROM completions ORDER BY last_used_at"):
+                    if excess <= 0:
+                        break
+                    evicted.append((key,))
+                    excess -= size
+                self._conn.executemany("DELETE FROM completions WHERE key = ?", evicted)
+        if expired or evicted:
+            self._logger.debug(f"Evicted {expired} expired and {len(evicted)} least recently used completions")
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,290 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+
+import aiohttp
+import openai
+from openai import error
+
+from .metrics import SyncMetrics
+from .tokens import count_tokens
+
+MODULE_NAME = __name__.split('.')[-1]
+
+
+class TokenBucket:
+    """Refills continuously at `rate_per_minute` up to `capacity` units. A rate of 0 means no limit."""
+    def __init__(self, rate_per_minute: float, capacity: float=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self._available = self.capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def delay_for(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they already are)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        missing = min(amount, self.capacity) - self._available
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float):
+        self._refill()
+        self._available -= min(amount, self.capacity)
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server told us we went too fast."""
+        self._refill()
+        self._available = min(self._available, 0.0)
+
+
+class RateLimiter:
+    """Requests/min and tokens/min limits, acquired together."""
+    # OpenAI enforces its limits over windows shorter than a minute, so only
+    # allow bursts of a few seconds' worth of quota.
+    BURST_SECONDS = 10
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        burst = self.BURST_SECONDS / 60
+        self._requests = TokenBucket(requests_per_minute, capacity=requests_per_minute * burst)
+        self._tokens = TokenBucket(tokens_per_minute, capacity=tokens_per_minute * burst)
+
+    async def acquire(self, tokens: int):
+        # There is no await between checking and consuming, so the event loop
+        # can't interleave another acquire in between and no lock is needed.
+        while True:
+            delay = max(self._requests.delay_for(1), self._tokens.delay_for(tokens))
+            if delay <= 0:
+                self._requests.consume(1)
+                self._tokens.consume(tokens)
+                return
+            await asyncio.sleep(delay)
+
+    def back_off(self):
+        self._requests.drain()
+        self._tokens.drain()
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, (error.RateLimitError, error.ServiceUnavailableError,
+                      error.Timeout, error.APIConnectionError, error.TryAgain)):
+        return True
+    # Generic API errors (bad gateway, internal errors, ...) are worth retrying
+    # but client errors such as invalid requests are not.
+    if isinstance(e, error.APIError):
+        return e.http_status is None or e.http_status >= 500
+    return False
+
+
+class CompletionEngine:
+    """Runs many completions concurrently while staying under the rate limits.
+
+    All requests of a run share one pooled aiohttp session so connections are
+    kept alive between completions.
+    """
+    def __init__(self,
+                 model: str,
+                 max_output_tokens: int,
+                 temperature: float=0.5,
+                 top_p: float=1,
+                 max_concurrency: int=8,
+                 requests_per_minute: float=3000,
+                 tokens_per_minute: float=250000,
+                 max_retries: int=6,
+                 min_backoff: float=1,
+                 max_backoff: float=60,
+                 request_timeout: float=60,
+                 cache=None):
+        self.model = model
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.cache = cache
+        self._limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self._metrics = SyncMetrics()
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+        return self
+
+    def close(self):
+        """Trim and close the cache; call once at the end of a sync."""
+        if self.cache:
+            self.cache.evict()
+            self._logger.info(f"Completion cache stats: {self.cache.stats()}")
+            self.cache.close()
+
+    def estimate_tokens(self, prompt: str, max_tokens: int) -> int:
+        return count_tokens(prompt, self.model) + max_tokens
+
+    def _backoff_delay(self, attempt: int, e: Exception) -> float:
+        # "Full jitter": spreads retries from many concurrent requests out so
+        # they don't all hit the API again at the same moment.
+        jitter = random.uniform(0, min(self.max_backoff, self.min_backoff * 2 ** attempt))
+        retry_after = getattr(e, "headers", None) and e.headers.get("retry-after")
+        try:
+            # Requests throttled together get the same Retry-After, so they
+            # still need spreading out after it
+            return float(retry_after) + jitter
+        except (TypeError, ValueError):
+            return jitter
+
+    def _params(self, prompt: str, max_tokens: int=None) -> dict:
+        return dict(engine=self.model,
+                    prompt=prompt,
+                    max_tokens=max_tokens or self.max_output_tokens,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    frequency_penalty=0,
+                    presence_penalty=0)
+
+    def discard(self, prompt: str, max_tokens: int=None):
+        """Drop a cached completion the caller couldn't use, so the next sync asks again."""
+        if self.cache:
+            self.cache.delete(self.cache.key(self._params(prompt, max_tokens)))
+
+    async def acomplete(self, prompt: str, max_tokens: int=None):
+        params = self._params(prompt, max_tokens)
+        max_tokens = params["max_tokens"]
+        if self.cache:
+            cache_key = self.cache.key(params)
+            response = self.cache.get(cache_key)
+            if response is not None:
+                self._metrics.increment("completion_cache_hits")
+                return response
+            self._metrics.increment("completion_cache_misses")
+        response = await self._with_retries(
+            lambda: openai.Completion.acreate(**params, request_timeout=self.request_timeout),
+            tokens=self.estimate_tokens(prompt, max_tokens),
+            metric="openai_completion")
+        # A cut-off completion would be cut off the same way every time
+        if self.cache and response.choices[0].finish_reason != "length":
+            self.cache.put(cache_key, response)
+        return response
+
+    async def _with_retries(self, make_request, tokens: int, metric: str):
+        attempt = 0
+        while True:
+            with self._metrics.span("rate_limit_wait"):
+                await self._limiter.acquire(tokens)
+            started_at = time.perf_counter()
+            try:
+                response = await make_request()
+            except error.OpenAIError as e:
+                self._metrics.observe(metric, time.perf_counter() - started_at,
+                                      status=e.http_status, error=type(e).__name__)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                self._metrics.increment("openai_retries")
+                if isinstance(e, error.RateLimitError):
+                    self._metrics.increment("openai_rate_limited")
+                    self._limiter.back_off()
+                delay = self._backoff_delay(attempt, e)
+                attempt += 1
+                self._logger.warning(f"Retrying request in {delay:.1f}s "
+                                     f"(attempt {attempt}/{self.max_retries}) after {e!r}")
+                await asyncio.sleep(delay)
+                continue
+            usage = response.get("usage") or {}
+            self._metrics.observe(metric, time.perf_counter() - started_at,
+                                  prompt_tokens=usage.get("prompt_tokens"),
+                                  completion_tokens=usage.get("completion_tokens"))
+            self._metrics.increment("openai_requests")
+            self._metrics.increment("openai_prompt_tokens", usage.get("prompt_tokens", 0))
+            self._metrics.increment("openai_completion_tokens", usage.get("completion_tokens", 0))
+            return response
+
+    @contextlib.asynccontextmanager
+    async def _pooled_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector,
+                                         trace_configs=[self._metrics.trace_config()]) as session:
+            # Tasks copy the current context, so setting the session here makes
+            # every request made inside reuse its pooled connections.
+            token = openai.aiosession.set(session)
+            try:
+                yield session
+            finally:
+                openai.aiosession.reset(token)
+
+    async def acomplete_many(self, prompts: list[str], max_tokens: list[int]=None) -> list:
+        """Complete all prompts, in order.
+
+        `max_tokens` optionally gives each prompt its own output limit. A
+        prompt that still fails after all retries gets its exception in place
+        of a response, so one bad highlight doesn't abort the batch.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        max_tokens = max_tokens or [None] * len(prompts)
+        num_waiting = 0
+        num_in_flight = 0
+
+        async def bounded_complete(prompt, max_tokens):
+            nonlocal num_waiting, num_in_flight
+            # Only tasks blocked on the semaphore are waiting
+            num_waiting += 1
+            self._metrics.gauge("completions_waiting", num_waiting)
+            async with semaphore:
+                num_waiting -= 1
+                num_in_flight += 1
+                self._metrics.gauge("completions_waiting", num_waiting)
+                self._metrics.gauge("completions_in_flight", num_in_flight)
+                try:
+                    return await self.acomplete(prompt, max_tokens)
+                finally:
+                    num_in_flight -= 1
+
+        async with self._pooled_session():
+            self._logger.info(f"Requesting {len(prompts)} completions")
+            responses = await asyncio.gather(*(bounded_complete(p, m) for p, m in zip(prompts, max_tokens)),
+                                             return_exceptions=True)
+        num_failed = sum(1 for r in responses if isinstance(r, Exception))
+        for r in responses:
+            if isinstance(r, Exception):
+                self._logger.error(f"Completion failed: {r!r}")
+        self._logger.info(f"Finished {len(prompts) - num_failed} completions, {num_failed} failed")
+        return responses
+
+    def complete_many(self, prompts: list[str], max_tokens: list[int]=None) -> list:
+        """Blocking wrapper around `acomplete_many` for use from worker threads."""
+        return asyncio.run(self.acomplete_many(prompts, max_tokens))
+
+    async def aembed_many(self, texts: list[str], model: str, batch_size: int=2048) -> list[list[float]]:
+        """Embed all texts, in order, sending up to `batch_size` per request."""
+        # Same request as the vendored embeddings_utils.aget_embeddings, which
+        # we can't import because it pulls in plotting and sklearn.
+        texts = [text.replace("\n", " ") for text in texts]
+
+        async def embed_batch(batch):
+            response = await self._with_retries(
+                lambda: openai.Embedding.acreate(input=batch, engine=model, request_timeout=self.request_timeout),
+                tokens=sum(count_tokens(text, model) for text in batch),
+                metric="openai_embedding")
+            data = sorted(response.data, key=lambda x: x["index"])  # maintain the same order as input.
+            return [d["embedding"] for d in data]
+
+        async with self._pooled_session():
+            batches = await asyncio.gather(*(
+                embed_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)))
+        return [embedding for batch in batches for embedding in batch]
+
+    def embed_many(self, texts: list[str], model: str) -> list[list[float]]:
+        """Blocking wrapper around `aembed_many` for use from worker threads."""
+        return asyncio.run(self.aembed_many(texts, model))
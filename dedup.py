@@ -0,0 +1,210 @@
+import ast
+import logging
+import os
+import struct
+
+from openai import error
+from openai.datalib import numpy as np, assert_has_numpy
+
+from .note_index import text_hash
+
+MODULE_NAME = __name__.split('.')[-1]
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+# Rows of the embedding matrix compared at once. Bounds the memory used on top
+# of the memory-mapped file.
+SIMILARITY_BLOCK_SIZE = 8192
+
+# .npy files are written with a fixed-size header, padded with spaces, so the
+# shape can be rewritten in place as rows are appended.
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_HEADER_SIZE = 128
+
+
+class AppendOnlyArray:
+    """A 2-D .npy file that rows are appended to, read back memory-mapped."""
+    def __init__(self, path: str, dtype, num_columns: int=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.num_columns = num_columns
+        self.num_rows = 0
+        if os.path.exists(path):
+            self.num_rows, self.num_columns = self._read_shape()
+
+    def _read_shape(self):
+        with open(self.path, "rb") as f:
+            header = f.read(NPY_HEADER_SIZE)
+        header_len, = struct.unpack("<H", header[len(NPY_MAGIC):len(NPY_MAGIC) + 2])
+        return ast.literal_eval(header[len(NPY_MAGIC) + 2:len(NPY_MAGIC) + 2 + header_len].decode("latin1"))["shape"]
+
+    def _write_header(self, f):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.num_rows, self.num_columns),
+        }).encode("latin1")
+        header_len = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+        f.seek(0)
+        f.write(NPY_MAGIC + struct.pack("<H", header_len) + header.ljust(header_len - 1) + b"\n")
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if not len(rows):
+            return
+        self.num_columns = self.num_columns or rows.shape[1]
+        with open(self.path, "r+b" if os.path.exists(self.path) else "w+b") as f:
+            # Write after the rows the header knows about, so a write that was
+            # interrupted earlier is simply overwritten.
+            f.seek(NPY_HEADER_SIZE + self.num_rows * self.num_columns * self.dtype.itemsize)
+            f.write(rows.tobytes())
+            self.num_rows += len(rows)
+            self._write_header(f)
+
+    def load(self):
+        if not self.num_rows:
+            return np.empty((0, self.num_columns or 0), dtype=self.dtype)
+        return np.load(self.path, mmap_mode="r")
+
+
+class EmbeddingIndex:
+    """Normalized float32 embeddings of highlights, keyed by highlight id.
+
+    Stored as two append-only .npy files: the embeddings and, row for row,
+    the (highlight id, text hash) they belong to. An edited highlight gets a
+    new row; its previous one is ignored.
+    """
+    def __init__(self, dirpath: str):
+        assert_has_numpy()
+        os.makedirs(dirpath, exist_ok=True)
+        self._vectors = AppendOnlyArray(os.path.join(dirpath, "embeddings.npy"), np.float32)
+        self._keys = AppendOnlyArray(os.path.join(dirpath, "embedding_keys.npy"), np.int64, num_columns=2)
+        # Rows past the shorter file were only partly written
+        num_rows = min(self._vectors.num_rows, self._keys.num_rows)
+        self._vectors.num_rows = self._keys.num_rows = num_rows
+        self._rows = {}
+        for row, (highlight_id, hash_) in enumerate(self._keys.load()[:num_rows]):
+            self._rows[int(highlight_id)] = (row, int(hash_))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, highlight_id: int):
+        return highlight_id in self._rows
+
+    @staticmethod
+    def _hash(text: str) -> int:
+        return int(text_hash(text), 16)
+
+    def missing(self, highlights) -> list:
+        """Highlights without an embedding of their current text."""
+        return [h for h in highlights if self._rows.get(h.id, (None, None))[1] != self._hash(h.text)]
+
+    def add(self, highlights, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        keys = np.array([(h.id, self._hash(h.text)) for h in highlights], dtype=np.int64)
+        first_row = self._vectors.num_rows
+        self._vectors.append(vectors)
+        self._keys.append(keys)
+        for i, h in enumerate(highlights):
+            self._rows[h.id] = (first_row + i, int(keys[i, 1]))
+
+    def rows(self, highlight_ids) -> "np.ndarray":
+        return np.array([self._rows[i][0] for i in highlight_ids if i in self._rows], dtype=np.int64)
+
+    def vectors(self, rows) -> "np.ndarray":
+        return np.asarray(self._vectors.load()[rows])
+
+    def max_similarity(self, queries, rows) -> "np.ndarray":
+        """For each query vector, its highest cosine similarity with the given rows."""
+        best = np.full(len(queries), -1.0, dtype=np.float32)
+        if not len(rows) or not len(queries):
+            return best
+        matrix = self._vectors.load()
+        rows = np.sort(rows)
+        for i in range(0, len(rows), SIMILARITY_BLOCK_SIZE):
+            block = matrix[rows[i:i + SIMILARITY_BLOCK_SIZE]]
+            np.maximum(best, (queries @ block.T).max(axis=1), out=best)
+        return best
+
+
+class DuplicateFilter:
+    """Drops highlights that are near-duplicates of ones that already have a card.
+
+    A highlight counts as covered once it has a note in the note index or was
+    kept earlier in this sync. Highlights whose cards were made before they
+    were embedded are embedded on the first chunk.
+    """
+    def __init__(self, embedding_index: EmbeddingIndex, embed, note_index, lookup_highlights,
+                 threshold: float=0.95):
+        self._embeddings = embedding_index
+        # Callable taking a list of texts and returning their embeddings
+        self._embed = embed
+        self._note_index = note_index
+        # Callable taking highlight ids and returning the stored highlights
+        self._lookup_highlights = lookup_highlights
+        self._threshold = threshold
+        self._backfilled = False
+        self._kept_ids = set()
+        self.num_dropped = 0
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def _ensure_embeddings(self, highlights):
+        missing = self._embeddings.missing(highlights)
+        if missing:
+            self._logger.debug(f"Embedding {len(missing)} highlights")
+            self._embeddings.add(missing, self._embed([h.text for h in missing]))
+
+    def _backfill(self):
+        unembedded = [i for i in self._note_index.highlight_ids() if i not in self._embeddings]
+        if not unembedded:
+            return
+        highlights = self._lookup_highlights(unembedded)
+        self._logger.info(f"Embedding {len(highlights)} highlights that already have cards")
+        self._ensure_embeddings(highlights)
+
+    def filter_documents(self, docs):
+        highlights = [h for doc in docs for h in doc.highlights]
+        if not highlights:
+            return docs
+        if not self._backfilled:
+            # Only tried once, highlights that still lack embeddings are just
+            # not compared against
+            self._backfilled = True
+            try:
+                self._backfill()
+            except error.OpenAIError as e:
+                self._logger.warning(f"Couldn't embed the highlights that already have cards: {e!r}")
+        try:
+            self._ensure_embeddings(highlights)
+        except error.OpenAIError as e:
+            self._logger.warning(f"Couldn't embed highlights, not checking them for duplicates: {e!r}")
+            return docs
+        ids = [h.id for h in highlights]
+        candidates = set(ids)
+        queries = self._embeddings.vectors(self._embeddings.rows(ids))
+        # Compare against everything covered before this chunk in one pass...
+        covered = (self._note_index.highlight_ids() | self._kept_ids) - candidates
+        duplicate = self._embeddings.max_similarity(queries, self._embeddings.rows(covered)) >= self._threshold
+        # ...then within the chunk, where earlier highlights win
+        similarities = queries @ queries.T
+        kept = []
+        for i in range(len(highlights)):
+            if not duplicate[i] and not (kept and (similarities[i, kept] >= self._threshold).any()):
+                kept.append(i)
+        kept_ids = {ids[i] for i in kept}
+        self._kept_ids |= kept_ids
+        num_dropped = len(highlights) - len(kept)
+        if num_dropped:
+            self.num_dropped += num_dropped
+            self._logger.info(f"Dropped {num_dropped} near-duplicate highlights")
+        filtered = []
+        for doc in docs:
+            doc.highlights = [h for h in doc.highlights if h.id in kept_ids]
+            if doc.highlights:
+                filtered.append(doc)
+        return filtered
@@ -0,0 +1,136 @@
+import datetime
+import logging
+import os
+import sqlite3
+
+from .readwise import ReadwiseDocument, ReadwiseHighlight
+
+MODULE_NAME = __name__.split('.')[-1]
+
+# Re-fetch a few minutes before the last sync started so clock skew between us
+# and Readwise can't make us miss an update. Upserts are idempotent.
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    user_book_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS highlights (
+    id INTEGER PRIMARY KEY,
+    user_book_id INTEGER NOT NULL,
+    updated_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS highlights_by_document ON highlights (user_book_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class HighlightStore:
+    """Local copy of the Readwise library so syncs only fetch what changed.
+
+    The connection is not shared between threads, so open the store in the
+    thread that uses it.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def close(self):
+        self._conn.close()
+
+    @property
+    def watermark(self):
+        """ISO timestamp to pass as `updatedAfter`, or None before the first sync."""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'updated_after'").fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, value: str):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('updated_after', ?)", (value,))
+
+    def upsert_documents(self, docs: list[ReadwiseDocument]):
+        """Insert or update documents and their highlights, removing discarded ones."""
+        num_removed = 0
+        for doc in docs:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (user_book_id, data) VALUES (?, ?)",
+                (doc.user_book_id, doc.to_json()))
+            removed = [(h.id,) for h in doc.highlights if h.is_discard or h.is_deleted]
+            kept = [(h.id, doc.user_book_id, h.updated_at, h.to_json())
+                    for h in doc.highlights if not (h.is_discard or h.is_deleted)]
+            self._conn.executemany("DELETE FROM highlights WHERE id = ?", removed)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO highlights (id, user_book_id, updated_at, data) VALUES (?, ?, ?, ?)",
+                kept)
+            num_removed += len(removed)
+        self._logger.debug(f"Stored {len(docs)} documents, removed {num_removed} highlights")
+
+    def iter_sync(self, client):
+        """Fetch the changes since the last sync, yielding each page once it's stored.
+
+        Yielded documents only keep the highlights that weren't removed. The
+        watermark only moves forward once every page is stored, so an
+        interrupted sync is simply repeated next time.
+        """
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        updated_after = self.watermark
+        self._logger.info(f"Syncing Readwise changes since {updated_after}")
+        for page in client.iter_export(updated_after=updated_after):
+            with self._conn:
+                self.upsert_documents(page)
+            for doc in page:
+                doc.highlights = [h for h in doc.highlights if not (h.is_discard or h.is_deleted)]
+            yield page
+        with self._conn:
+            self._set_watermark((started_at - SYNC_OVERLAP).isoformat())
+
+    def sync(self, client):
+        return [d for page in self.iter_sync(client) for d in page]
+
+    def iter_documents(self, exclude=(), page_size=100):
+        """Yield the stored documents in pages of `page_size`, skipping ids in `exclude`."""
+        user_book_ids = [
+            user_book_id for user_book_id, in self._conn.execute(
+                "SELECT user_book_id FROM documents ORDER BY user_book_id")
+            if user_book_id not in exclude
+        ]
+        for i in range(0, len(user_book_ids), page_size):
+            page_ids = user_book_ids[i:i + page_size]
+            placeholders = ", ".join("?" * len(page_ids))
+            highlights = {}
+            for user_book_id, data in self._conn.execute(
+                    f"SELECT user_book_id, data FROM highlights WHERE user_book_id IN ({placeholders}) "
+                    "ORDER BY id", page_ids):
+                highlights.setdefault(user_book_id, []).append(ReadwiseHighlight.from_json(data))
+            yield [
+                ReadwiseDocument.from_json(data, highlights=highlights.get(user_book_id, []))
+                for user_book_id, data in self._conn.execute(
+                    f"SELECT user_book_id, data FROM documents WHERE user_book_id IN ({placeholders}) "
+                    "ORDER BY user_book_id", page_ids)
+            ]
+
+    def highlights(self, highlight_ids, batch_size=500) -> list[ReadwiseHighlight]:
+        """The stored highlights with the given ids, skipping ones that aren't stored."""
+        highlight_ids = list(highlight_ids)
+        highlights = []
+        # Batched to stay under SQLite's limit on query parameters
+        for i in range(0, len(highlight_ids), batch_size):
+            batch = highlight_ids[i:i + batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            highlights.extend(
+                ReadwiseHighlight.from_json(data) for data, in self._conn.execute(
+                    f"SELECT data FROM highlights WHERE id IN ({placeholders})", batch))
+        return highlights
+
+    def documents(self) -> list[ReadwiseDocument]:
+        return [d for page in self.iter_documents() for d in page]
@@ -12,10 +12,12 @@ class JsonFormatter(logging.Formatter):
             "logger": record.name,
             "message": record.getMessage(),
         }
+        # Structured fields passed with `extra={"fields": {...}}`, e.g. metrics
+        log_record.update(getattr(record, "fields", {}))
         # If the record has exception information, add it to the log record
         if record.exc_info:
             log_record["exception"] = self.formatException(record.exc_info)
-        return json.dumps(log_record)
+        return json.dumps(log_record, default=str)
 
 
 def make_logger(name, filepath=None, level=None):
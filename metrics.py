@@ -0,0 +1,118 @@
+import contextlib
+import logging
+import math
+import threading
+import time
+from typing import Optional
+
+MODULE_NAME = __name__.split('.')[-1]
+
+
+def percentile(sorted_values: list[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list, None if it's empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class SyncMetrics:
+    """Timing spans, counters and gauges for one sync.
+
+    Every observation is logged as a structured record (the JsonFormatter adds
+    the `fields` to the JSON), and `log_summary` ends the sync with totals and
+    p50/p95 latencies. It's shared by the worker and the main thread.
+    """
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._latencies = {}
+        self._gauges = {}
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def _log(self, message: str, **fields):
+        self._logger.debug(message, extra={"fields": fields})
+
+    def increment(self, name: str, value: float=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        """Record a level such as a queue depth; the summary has its maximum and mean."""
+        with self._lock:
+            maximum, total, count = self._gauges.get(name, (value, 0, 0))
+            self._gauges[name] = (max(maximum, value), total + value, count + 1)
+
+    def observe(self, name: str, seconds: float, **fields):
+        with self._lock:
+            self._latencies.setdefault(name, []).append(seconds)
+        self._log(name, metric=name, seconds=seconds, **fields)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **fields):
+        """Time the block and observe it under `name`. Yields a dict for extra fields."""
+        extra = {}
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            self.observe(name, time.perf_counter() - start, **fields, **extra)
+
+    def trace_config(self):
+        """An aiohttp TraceConfig observing every HTTP request as `http_request`."""
+        import aiohttp
+
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            self.observe("http_request", time.perf_counter() - context.start,
+                         method=params.method, url=str(params.url.with_query(None)),
+                         status=params.response.status)
+
+        async def on_request_exception(session, context, params):
+            self.increment("http_request_errors")
+            self.observe("http_request", time.perf_counter() - context.start,
+                         method=params.method, url=str(params.url.with_query(None)),
+                         error=repr(params.exception))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def summary(self) -> dict:
+        wall_seconds = time.perf_counter() - self.started_at
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            latencies = {name: sorted(values) for name, values in self._latencies.items()}
+        summary = {
+            "wall_seconds": wall_seconds,
+            "counters": counters,
+            "gauges": {
+                name: {"max": maximum, "mean": total / count}
+                for name, (maximum, total, count) in gauges.items()
+            },
+            "latencies": {
+                name: {
+                    "count": len(values),
+                    "total_seconds": sum(values),
+                    "p50_seconds": percentile(values, 50),
+                    "p95_seconds": percentile(values, 95),
+                }
+                for name, values in latencies.items()
+            },
+        }
+        notes_written = counters.get("notes_written", 0)
+        summary["notes_per_second"] = notes_written / wall_seconds if wall_seconds else None
+        return summary
+
+    def log_summary(self):
+        self._logger.info("Sync finished", extra={"fields": {"summary": self.summary()}})
@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+MODULE_NAME = __name__.split('.')[-1]
+
+# Notes are tagged with the highlight they were made from, e.g.
+# smoothbrain::highlight::123456::0123456789ab, so the index can always be
+# rebuilt from the collection.
+TAG_PREFIX = "smoothbrain::highlight::"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    highlight_id INTEGER PRIMARY KEY,
+    note_id INTEGER NOT NULL,
+    text_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def highlight_tag(highlight_id: int, hash_: str) -> str:
+    return f"{TAG_PREFIX}{highlight_id}::{hash_}"
+
+
+def parse_highlight_tag(tag: str):
+    """Return (highlight_id, text_hash) for a highlight tag, None for other tags."""
+    if not tag.startswith(TAG_PREFIX):
+        return None
+    highlight_id, _, hash_ = tag[len(TAG_PREFIX):].partition("::")
+    try:
+        return int(highlight_id), hash_
+    except ValueError:
+        return None
+
+
+class NoteIndex:
+    """Maps Readwise highlight ids to the Anki notes made from them.
+
+    The whole index is mirrored in memory so lookups don't touch the disk.
+    It's used from both the worker thread and the main thread. Entries stay
+    after their note is deleted, so a deleted card isn't generated again.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._notes = {
+            highlight_id: (note_id, hash_)
+            for highlight_id, note_id, hash_ in self._conn.execute(
+                "SELECT highlight_id, note_id, text_hash FROM notes")
+        }
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return len(self._notes)
+
+    @property
+    def needs_rebuild(self) -> bool:
+        """Whether the index was never read from the collection, e.g. it was just created."""
+        return self._conn.execute("SELECT 1 FROM meta WHERE key = 'rebuilt_at'").fetchone() is None
+
+    def highlight_ids(self) -> set:
+        """Snapshot of the ids of the highlights that have notes."""
+        with self._lock:
+            return set(self._notes)
+
+    def get(self, highlight_id: int):
+        """Return (note_id, text_hash) for a highlight, or None if it has no note."""
+        return self._notes.get(highlight_id)
+
+    def record(self, entries):
+        """Store (highlight_id, note_id, text_hash) entries."""
+        entries = list(entries)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO notes (highlight_id, note_id, text_hash) VALUES (?, ?, ?)",
+                entries)
+            self._notes.update((h, (n, t)) for h, n, t in entries)
+
+    def rebuild(self, col):
+        """Add the highlight tags of the notes in the collection to the index.
+
+        Scans every note, so only needed when the index is new. Entries of
+        deleted notes are kept.
+        """
+        entries = []
+        for note_id, tags in col.db.all(
+                "SELECT id, tags FROM notes WHERE tags LIKE ?", f"%{TAG_PREFIX}%"):
+            for tag in tags.split():
+                parsed = parse_highlight_tag(tag)
+                if parsed:
+                    entries.append((parsed[0], note_id, parsed[1]))
+        self.record(entries)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', datetime('now'))")
+        self._logger.info(f"Rebuilt note index with {len(entries)} highlights")
+
+    def filter_documents(self, docs):
+        """Keep only highlights without a note or whose text changed since it was made."""
+        num_skipped = 0
+        filtered = []
+        for doc in docs:
+            highlights = [
+                h for h in doc.highlights
+                if self._notes.get(h.id, (None, None))[1] != text_hash(h.text)
+            ]
+            num_skipped += len(doc.highlights) - len(highlights)
+            if highlights:
+                doc.highlights = highlights
+                filtered.append(doc)
+        if num_skipped:
+            self._logger.debug(f"Skipped {num_skipped} highlights that already have notes")
+        return filtered
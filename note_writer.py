@@ -0,0 +1,133 @@
+import logging
+import time
+from dataclasses import dataclass
+
+from .metrics import SyncMetrics
+from .note_index import highlight_tag, parse_highlight_tag
+
+MODULE_NAME = __name__.split('.')[-1]
+
+# Notes written per CollectionOp. Each chunk is one transaction, one undo step
+# and one UI refresh.
+DEFAULT_CHUNK_SIZE = 500
+
+
+@dataclass
+class Flashcard:
+    highlight_id: int
+    text_hash: str
+    question: str
+    answer: str
+
+
+def write_flashcards(col, flashcards: list[Flashcard], deck_id: int, note_index):
+    """Add or update the notes for `flashcards` as a single undo step.
+
+    Runs inside a CollectionOp, i.e. on a background thread.
+    """
+    from anki.collection import AddNoteRequest
+    from anki.errors import NotFoundError
+    undo_position = col.add_custom_undo_entry(f"Add {len(flashcards)} Readwise Flashcards")
+    model = col.models.by_name("Basic")
+    add_requests = []
+    updated_notes = []
+    written = []
+    for card in flashcards:
+        note = None
+        existing = note_index.get(card.highlight_id)
+        if existing:
+            try:
+                note = col.get_note(existing[0])
+            except NotFoundError:
+                pass
+        if note:
+            # The highlight was edited, so update its note in place
+            note.tags = [t for t in note.tags if not parse_highlight_tag(t)]
+            updated_notes.append(note)
+        else:
+            note = col.new_note(model)
+            add_requests.append(AddNoteRequest(note=note, deck_id=deck_id))
+        note["Front"] = card.question
+        note["Back"] = card.answer
+        note.tags.append(highlight_tag(card.highlight_id, card.text_hash))
+        written.append((card, note))
+    if add_requests:
+        col.add_notes(add_requests)
+    if updated_notes:
+        col.update_notes(updated_notes)
+    # add_notes() has set the ids of the new notes by now
+    note_index.record((card.highlight_id, note.id, card.text_hash) for card, note in written)
+    return col.merge_undo_entries(undo_position)
+
+
+class NoteWriter:
+    """Writes flashcards to the collection in chunks, one CollectionOp per chunk.
+
+    Must be used from the main thread.
+    """
+    def __init__(self, parent, deck_id: int, note_index, chunk_size: int=DEFAULT_CHUNK_SIZE):
+        self._parent = parent
+        self._deck_id = deck_id
+        self._note_index = note_index
+        self._chunk_size = chunk_size
+        self.num_written = 0
+        self._num_pending = 0
+        self._on_finished = None
+        self._metrics = SyncMetrics()
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+        return self
+
+    def _write_chunk(self, col, chunk):
+        started_at = time.perf_counter()
+        changes = write_flashcards(col, chunk, self._deck_id, self._note_index)
+        self._metrics.observe("note_write_chunk", time.perf_counter() - started_at, notes=len(chunk))
+        return changes
+
+    def _on_chunk_done(self):
+        self._num_pending -= 1
+        if not self._num_pending and self._on_finished:
+            self._on_finished()
+            self._on_finished = None
+
+    def _on_chunk_written(self, num_cards):
+        from aqt.utils import tooltip
+        self._metrics.increment("notes_written", num_cards)
+        self.num_written += num_cards
+        self._logger.info(f"Wrote {num_cards} notes ({self.num_written} in total)")
+        tooltip(f"Added {self.num_written} Readwise flashcards", parent=self._parent)
+        self._on_chunk_done()
+
+    def _on_chunk_failed(self, e):
+        from aqt.utils import showWarning
+        self._logger.exception(e, exc_info=e)
+        showWarning(f"Couldn't add Readwise flashcards: {e}", parent=self._parent)
+        self._on_chunk_done()
+
+    def write(self, flashcards: list[Flashcard]):
+        from aqt.operations import CollectionOp
+        for i in range(0, len(flashcards), self._chunk_size):
+            chunk = flashcards[i:i + self._chunk_size]
+            self._num_pending += 1
+            self._metrics.gauge("note_chunks_pending", self._num_pending)
+            CollectionOp(
+                parent=self._parent,
+                op=lambda col, chunk=chunk: self._write_chunk(col, chunk),
+            ).success(
+                lambda _, chunk=chunk: self._on_chunk_written(len(chunk))
+            ).failure(
+                self._on_chunk_failed
+            ).run_in_background()
+
+    def finish(self, on_finished):
+        """Call `on_finished` once every chunk written so far is in the collection."""
+        self._on_finished = on_finished
+        if not self._num_pending:
+            self._on_finished()
+            self._on_finished = None
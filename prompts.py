@@ -0,0 +1,100 @@
+import re
+
+PROMPT_TEMPLATE = """
+    Make a succinct flash card for the following:
+    
+    {}
+    
+    Remember to:
+    1. Be straight to the point.
+    2. Only test ONE fact.
+    3. Prefer Q&A format.
+    """
+
+# Several highlights packed into one request. The prompt ends with the start of
+# the first card, so the completion continues in the same format.
+PACKED_PROMPT_TEMPLATE = """
+    Make a succinct flash card for each of the following numbered highlights.
+
+    {}
+
+    Remember to:
+    1. Be straight to the point.
+    2. Only test ONE fact per card.
+    3. Use Q&A format.
+    4. Make exactly one card per highlight, under its number, like this:
+
+    ### <highlight number>
+    Q: <question>
+    A: <answer>
+
+    Flashcards:
+
+    """
+PACKED_PROMPT_PRIMER = "### 1\nQ:"
+PACKED_HIGHLIGHT_TEMPLATE = "### {}\n{}\n"
+PACKED_CARD_RE = re.compile(r"^\s*###\s*(\d+)\s*$", re.MULTILINE)
+# The answer starts on its own line, so an "A:" inside the question (e.g.
+# "What is DNA: ...") doesn't split the card
+ANSWER_RE = re.compile(r"^\s*A:", re.MULTILINE)
+
+
+def parse_card(completion: str):
+    """Split a "Q: ... A: ..." completion into (question, answer), or None if it isn't one."""
+    parts = ANSWER_RE.split(completion.strip(), maxsplit=1)
+    if len(parts) != 2:
+        return None
+    question, answer = parts
+    question = question.strip()
+    if question.startswith("Q:"):
+        question = question[len("Q:"):]
+    question, answer = question.strip(), answer.strip()
+    if not question or not answer:
+        return None
+    return question, answer
+
+
+def render_packed_prompt(highlights) -> str:
+    numbered = "\n".join(PACKED_HIGHLIGHT_TEMPLATE.format(i, h.text) for i, h in enumerate(highlights, 1))
+    return PACKED_PROMPT_TEMPLATE.format(numbered) + PACKED_PROMPT_PRIMER
+
+
+def parse_packed_completion(completion: str, num_highlights: int) -> list[tuple[str, str]]:
+    """Return one (question, answer) per packed highlight, in order.
+
+    Raises ValueError if any card is missing, duplicated or malformed.
+    """
+    parts = PACKED_CARD_RE.split(PACKED_PROMPT_PRIMER + completion)
+    # parts = [preamble, number, card, number, card, ...]
+    cards = {}
+    for number, text in zip(parts[1::2], parts[2::2]):
+        number = int(number)
+        card = parse_card(text)
+        if card is None or number in cards or not 1 <= number <= num_highlights:
+            raise ValueError(f"Bad card #{number} in packed completion: {text!r}")
+        cards[number] = card
+    if len(cards) != num_highlights:
+        raise ValueError(f"Expected {num_highlights} cards in packed completion, got {len(cards)}")
+    return [cards[i] for i in range(1, num_highlights + 1)]
+
+
+def pack_highlights(highlights, token_budget: int, output_tokens_per_card: int, count_tokens,
+                    max_highlights: int=20) -> list[list]:
+    """Greedily group highlights so each packed request fits in `token_budget`.
+
+    The budget covers the prompt plus `output_tokens_per_card` for every card
+    in the response. A highlight too large to share a request gets its own.
+    """
+    base_tokens = count_tokens(PACKED_PROMPT_TEMPLATE.format("") + PACKED_PROMPT_PRIMER)
+    batches = []
+    batch, batch_tokens = [], base_tokens
+    for h in highlights:
+        tokens = count_tokens(PACKED_HIGHLIGHT_TEMPLATE.format(len(batch) + 1, h.text)) + output_tokens_per_card
+        if batch and (batch_tokens + tokens > token_budget or len(batch) >= max_highlights):
+            batches.append(batch)
+            batch, batch_tokens = [], base_tokens
+        batch.append(h)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
@@ -1,61 +1,125 @@
 import requests
 import datetime
+import json
 import logging
-from dataclasses import dataclass
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import SyncMetrics
 
 MODULE_NAME = __name__.split('.')[-1]
 
-@dataclass
-class ReadwiseHighlight:
-    id: int
-    external_id: str
-    text: str
-    note: str
-    location: int
-    end_location: int
-    location_type: str
-    color: str
-    highlighted_at: str
-    created_at: str
-    updated_at: str
-    url: str
-    book_id: int
-    tags: list[str]
-    is_favorite: bool
-    is_discard: bool
-    readwise_url: str
-
-
-@dataclass
-class ReadwiseDocument:
-    user_book_id: int
-    # Amazon Standard Identification Number (ASIN)
-    # This is not always populated.
-    asin: str
-    title: str
-    readable_title: str
-    author: str
-    cover_image_url: str
-    source_url: str
-    # Share URL (read.readwise.io/...)
-    unique_url: str
-    readwise_url: str
-    book_tags: list[str]
-    category: str  # ENUM
-    source: str
-    document_note: str
-    highlights: list[ReadwiseHighlight]
-
-    def __post_init__(self):
-        self.highlights = [ReadwiseHighlight(**h) for h in self.highlights]
+DEFAULT_BASE_URL = "https://readwise.io/api/v2"
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ReadwiseRecord:
+    """A record parsed from the export API's JSON.
+
+    The fields the sync uses are kept in slots. The rest are kept as a
+    compact JSON slice, decoded once when one of them is first accessed.
+    """
+    __slots__ = ("_lazy_json", "_lazy")
+    # Fields kept in slots and stored by `to_json`
+    FIELDS = ()
+    # Fields only decoded on access
+    LAZY_FIELDS = ()
+    # Key of the lazy fields' JSON slice in the JSON from `to_json`
+    LAZY_KEY = "lazy_fields"
+
+    def _set_lazy_fields(self, data: dict, lazy_json: str=None):
+        if lazy_json is None:
+            lazy_json = json.dumps({key: data[key] for key in self.LAZY_FIELDS if key in data},
+                                   separators=(",", ":"))
+        self._lazy_json = lazy_json
+        self._lazy = None
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, i.e. the lazy fields
+        if name not in self.LAZY_FIELDS:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        if self._lazy is None:
+            # A tuple in LAZY_FIELDS order is much smaller than the dict
+            data = json.loads(self._lazy_json)
+            self._lazy = tuple(data.get(key) for key in self.LAZY_FIELDS)
+            self._lazy_json = None
+        return self._lazy[self.LAZY_FIELDS.index(name)]
+
+    @classmethod
+    def from_json(cls, json_text: str, **kwargs):
+        data = json.loads(json_text)
+        return cls(data, lazy_json=data[cls.LAZY_KEY], **kwargs)
+
+    def to_json(self) -> str:
+        """Encode the record for `from_json`, with the lazy fields as their JSON slice."""
+        lazy_json = self._lazy_json
+        if lazy_json is None:
+            lazy_json = json.dumps(dict(zip(self.LAZY_FIELDS, self._lazy)), separators=(",", ":"))
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data[self.LAZY_KEY] = lazy_json
+        return json.dumps(data, separators=(",", ":"))
+
+
+class ReadwiseHighlight(ReadwiseRecord):
+    FIELDS = ("id", "text", "updated_at", "is_discard", "is_deleted", "location_type", "color")
+    __slots__ = FIELDS
+    LAZY_FIELDS = ("external_id", "note", "location", "end_location", "highlighted_at", "created_at",
+                   "url", "book_id", "tags", "is_favorite", "readwise_url")
+
+    def __init__(self, data: dict, lazy_json: str=None):
+        self.id = data["id"]
+        self.text = data["text"]
+        self.updated_at = data["updated_at"]
+        self.is_discard = data["is_discard"]
+        # Only sent for highlights deleted since an `updatedAfter` timestamp.
+        self.is_deleted = data.get("is_deleted", False)
+        # Repeated across most highlights, so shared instead of kept once per highlight
+        self.location_type = intern(data.get("location_type"))
+        self.color = intern(data.get("color"))
+        self._set_lazy_fields(data, lazy_json)
+
+
+class ReadwiseDocument(ReadwiseRecord):
+    FIELDS = ("user_book_id", "title", "category", "source")
+    __slots__ = FIELDS + ("highlights",)
+    LAZY_FIELDS = (
+        # Amazon Standard Identification Number (ASIN)
+        # This is not always populated.
+        "asin",
+        "readable_title",
+        "author",
+        "cover_image_url",
+        "source_url",
+        # Share URL (read.readwise.io/...)
+        "unique_url",
+        "readwise_url",
+        "book_tags",
+        "document_note",
+    )
+
+    def __init__(self, data: dict, highlights: list[ReadwiseHighlight]=None, lazy_json: str=None):
+        if highlights is None:
+            # The highlights are stored separately, so they aren't part of the record's JSON
+            highlights = [ReadwiseHighlight(h) for h in data.get("highlights", ())]
+        self.user_book_id = data["user_book_id"]
+        self.title = data["title"]
+        self.category = intern(data["category"])  # ENUM
+        self.source = intern(data["source"])
+        self.highlights = highlights
+        self._set_lazy_fields(data, lazy_json)
 
 
 class ReadwiseClient:
     def __init__(self, api_key: str=None):
-        self._base_url = f"https://readwise.io/api/v2"
+        self._base_url = DEFAULT_BASE_URL
         self._parent_logger = None
         self._logger = logging.getLogger(MODULE_NAME)
         self.latest_fetch_time = None
+        self._metrics = SyncMetrics()
         self.set_api_key(api_key)
 
     def set_parent_logger(self, parent_logger):
@@ -63,49 +127,73 @@ class ReadwiseClient:
         self._logger = self._parent_logger.getChild(MODULE_NAME)
         return self
 
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+        return self
+
     def set_api_key(self, api_key):
         self._api_key = api_key
         return self
+
+    def set_base_url(self, base_url):
+        self._base_url = base_url.rstrip("/")
+        return self
     
     def _update_time(self):
         self.latest_fetch_time = datetime.datetime.now()
     
+    def _fetch_page(self, session, params):
+        self._logger.debug(f"Making Readwise export API request with params={params}")
+        started_at = time.perf_counter()
+        response = session.get(
+            url=f"{self._base_url}/export/",
+            params=params,
+            headers={"Authorization": f"Token {self._api_key}"},
+            verify=True)
+        try:
+            response.raise_for_status()
+            json_data = response.json()
+            self._metrics.observe("readwise_page", time.perf_counter() - started_at,
+                                  status=response.status_code, documents=len(json_data["results"]))
+            return json_data
+        except Exception as e:
+            self._logger.debug({"response": response.text}, exc_info=e)
+            self._logger.exception(e, exc_info=e)
+            raise e
+
     # Taken from https://readwise.io/api_deets
-    def export(self, updated_after=None):
+    def iter_export(self, updated_after=None):
+        """Yield the export one page (a list of documents) at a time.
+
+        Requests share one pooled session, and the next page is fetched in the
+        background while the caller processes the current one.
+        """
         self._logger.info("Exporting Readwise data")
         self._update_time()
-        full_data = []
-        next_page_cursor = None
-        while True:
-            params = {}
-            if next_page_cursor: params["pageCursor"] = next_page_cursor
-            if updated_after: params["updatedAfter"] = updated_after
-            self._logger.debug(f"Making Readwise export API request with params={params}")
-            response = requests.get(
-                url=f"{self._base_url}/export/",
-                params=params,
-                headers={"Authorization": f"Token {self._api_key}"},
-                verify=True)
-            try:
-                response.raise_for_status()
-                json_data = response.json()
-                results = json_data["results"]
-            except Exception as e:
-                self._logger.debug({"response": response.text}, exc_info=e)
-                self._logger.exception(e, exc_info=e)
-                raise e
-            full_data.extend(ReadwiseDocument(**d) for d in results)
-            self._logger.debug(f"Fetched {len(results)} documents in this page")
-            next_page_cursor = json_data.get("nextPageCursor")
-            if not next_page_cursor: break
+        base_params = {"updatedAfter": updated_after} if updated_after else {}
+        num_docs = num_highlights = 0
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_page = prefetcher.submit(self._fetch_page, session, base_params)
+            while next_page:
+                json_data = next_page.result()
+                next_page_cursor = json_data.get("nextPageCursor")
+                next_page = next_page_cursor and prefetcher.submit(
+                    self._fetch_page, session, {**base_params, "pageCursor": next_page_cursor})
+                page = [ReadwiseDocument(d) for d in json_data["results"]]
+                self._logger.debug(f"Fetched {len(page)} documents in this page")
+                num_docs += len(page)
+                num_highlights += sum(len(d.highlights) for d in page)
+                yield page
         self._logger.info("Finished exporting Readwise data")
-        self._logger.debug(f"Fetched {len(full_data)} documents in total")
+        self._logger.debug(f"Fetched {num_docs} documents in total")
+        self._logger.debug(f"Fetched {num_highlights} highlights in total")
+
+    def export(self, updated_after=None):
+        full_data = [d for page in self.iter_export(updated_after) for d in page]
         num_doc_notes = sum(1 for d in full_data if d.document_note)
         self._logger.debug(f"Fetched {num_doc_notes} document notes in total")
-        num_highlights = sum(len(d.highlights) for d in full_data if d.highlights)
-        self._logger.debug(f"Fetched {num_highlights} highlights in total")
         return full_data
-    
+
     def updates(self):
         if not self.latest_fetch_time: return self.export()
         self._update_time()
@@ -0,0 +1,180 @@
+import logging
+import threading
+
+from aqt import mw
+from aqt.operations import QueryOp
+from aqt.utils import showWarning, tooltip
+
+from .metrics import SyncMetrics
+from .note_writer import NoteWriter
+
+MODULE_NAME = __name__.split('.')[-1]
+
+
+class SyncScheduler:
+    """Runs the Readwise sync in the background, one at a time.
+
+    Syncs requested while one is running, from the menu, its shortcut or
+    after an AnkiWeb sync, are coalesced into a single sync that starts once
+    it finishes. A cancelled sync drops the chunk it's working on; the notes
+    written so far are in the note index, so the next sync skips them.
+
+    Must be used from the main thread.
+    """
+    def __init__(self):
+        self._running = False
+        self._pending = False
+        self._closing = False
+        self._cancelled = threading.Event()
+        self._metrics = None
+        self._note_writer = None
+        self._logger = logging.getLogger(MODULE_NAME)
+
+    def set_parent_logger(self, parent_logger):
+        self._logger = parent_logger.getChild(MODULE_NAME)
+        return self
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @property
+    def metrics(self):
+        """The metrics of the running sync, or of the last one."""
+        return self._metrics
+
+    def request_sync(self, reason: str="menu"):
+        if self._closing or mw.col is None:
+            self._logger.info(f"Ignoring sync requested from {reason}, no profile is open")
+            return
+        if self._running:
+            # The follow-up sync picks up whatever this one didn't
+            self._pending = True
+            self._logger.info(f"Sync requested from {reason} while one is running, it will run next")
+            tooltip("A Readwise sync is already running, another one will follow", parent=mw)
+            return
+        self._start(reason)
+
+    def cancel(self):
+        if not self._running:
+            tooltip("No Readwise sync is running", parent=mw)
+            return
+        self._pending = False
+        self._cancelled.set()
+        self._logger.info("Cancelling sync")
+        tooltip("Stopping the Readwise sync...", parent=mw)
+
+    def on_profile_will_close(self):
+        self._closing = True
+        if self._running:
+            self._pending = False
+            self._cancelled.set()
+
+    def on_profile_did_open(self):
+        self._closing = False
+
+    def _start(self, reason: str):
+        # Loads the pipeline and the vendored libraries on the first sync
+        from aqt.operations.deck import add_deck
+        from . import sync
+        self.set_parent_logger(sync.logger)
+        self._logger.info(f"Starting sync requested from {reason}")
+        self._running = True
+        self._cancelled.clear()
+        self._metrics = SyncMetrics().set_parent_logger(sync.logger)
+        try:
+            config = sync.get_config()
+            sync.setup_openai(config)
+        except Exception as e:
+            self._on_failed(e)
+            return
+        tooltip("Syncing Readwise highlights in the background...", parent=mw)
+        # TODO: Make the deck have a certain template
+        add_deck(parent=mw, name=config["deck_name"]).success(
+            lambda deck: self._generate(sync, config, deck.id)
+        ).failure(
+            self._on_failed
+        ).run_in_background()
+
+    def _generate(self, sync, config, deck_id: int):
+        metrics = self._metrics
+        try:
+            note_index = sync.get_note_index()
+            completion_engine = sync.make_completion_engine(config).set_metrics(metrics)
+        except Exception as e:
+            self._on_failed(e)
+            return
+        self._note_writer = note_writer = NoteWriter(parent=mw, deck_id=deck_id, note_index=note_index) \
+            .set_parent_logger(sync.logger).set_metrics(metrics)
+
+        def generate_all(_):
+            try:
+                # Add the notes on the main thread while the next chunk is generated
+                sync.sync_highlights(config, completion_engine, metrics,
+                                     write=lambda flashcards: mw.taskman.run_on_main(lambda: self._write(flashcards)),
+                                     cancelled=self._cancelled)
+            finally:
+                completion_engine.close()
+
+        def start_generating(_):
+            # Without the collection, so the CollectionOps writing the notes,
+            # and the user's own changes, aren't queued behind the whole sync.
+            # Notes queued by the op are written before these callbacks run,
+            # since both go through the main thread in order.
+            QueryOp(
+                parent=mw,
+                op=generate_all,
+                success=lambda _: note_writer.finish(self._on_finished),
+            ).failure(
+                lambda e: note_writer.finish(lambda: self._on_failed(e))
+            ).without_collection().run_in_background()
+
+        def on_rebuild_failed(e):
+            completion_engine.close()
+            self._on_failed(e)
+
+        if not note_index.needs_rebuild:
+            start_generating(None)
+            return
+        # A new index first reads which highlights already have notes from
+        # the tags in the collection
+        QueryOp(
+            parent=mw,
+            op=note_index.rebuild,
+            success=start_generating,
+        ).failure(
+            on_rebuild_failed
+        ).run_in_background()
+
+    def _write(self, flashcards):
+        # Cancellation is only checked between chunks, so the chunk being
+        # generated can still arrive after the profile started closing
+        if self._closing or self._cancelled.is_set():
+            self._logger.info(f"Not adding {len(flashcards)} flashcards, the sync was cancelled")
+            return
+        self._note_writer.write(flashcards)
+
+    def _on_finished(self):
+        num_written = self._note_writer.num_written
+        if self._cancelled.is_set():
+            tooltip(f"Readwise sync stopped after adding {num_written} flashcards. "
+                    "The next sync continues from there.", parent=mw)
+        else:
+            tooltip(f"Readwise sync finished, added {num_written} flashcards", parent=mw)
+        self._finish()
+
+    def _on_failed(self, e: Exception):
+        self._logger.exception(e, exc_info=e)
+        showWarning(f"Readwise sync failed: {e}", parent=mw)
+        self._finish()
+
+    def _finish(self):
+        self._metrics.log_summary()
+        self._running = False
+        self._note_writer = None
+        if self._pending and not self._closing:
+            self._pending = False
+            self._start("a request made during the last sync")
+
+
+scheduler = SyncScheduler()
@@ -0,0 +1,294 @@
+import contextlib
+import os
+import pathlib
+
+from aqt import mw
+
+# We vendor the OpenAI module so need to import it after the add-on has updated sys.path
+import openai
+from openai.datalib import HAS_NUMPY
+
+from .completion_cache import CompletionCache
+from .completions import CompletionEngine
+from .dedup import DEFAULT_EMBEDDING_MODEL, DuplicateFilter, EmbeddingIndex
+from .highlight_store import HighlightStore
+from .metrics import SyncMetrics
+from .note_index import NoteIndex, text_hash
+from .note_writer import Flashcard
+from .prompts import PROMPT_TEMPLATE, pack_highlights, parse_card, parse_packed_completion, render_packed_prompt
+from .readwise import DEFAULT_BASE_URL as READWISE_BASE_URL, ReadwiseClient
+from .tokens import count_tokens
+from .logging_utils import make_logger
+from . import IMPORT_SECONDS
+
+ADDON_ROOT_DIR = pathlib.Path(__file__).parent.resolve()
+ADDON_NAME = mw.addonManager.addonFromModule(__name__)
+LOG_FILE = os.path.join(ADDON_ROOT_DIR, f"{ADDON_NAME}.log")
+# Anki keeps the user_files folder when the add-on is updated
+USER_FILES_DIR = os.path.join(ADDON_ROOT_DIR, "user_files")
+HIGHLIGHT_STORE_FILE = os.path.join(USER_FILES_DIR, "readwise.sqlite3")
+COMPLETION_CACHE_FILE = os.path.join(USER_FILES_DIR, "completions.sqlite3")
+# One note index per profile, since each has its own collection
+NOTE_INDEX_DIR = os.path.join(USER_FILES_DIR, "note_index")
+EMBEDDINGS_DIR = os.path.join(USER_FILES_DIR, "embeddings")
+logger = make_logger(ADDON_NAME, filepath=LOG_FILE)
+# Importing the add-on only registers the menu action, so it should barely
+# register in Anki's startup time
+IMPORT_TIME_BUDGET_SECONDS = 0.05
+if IMPORT_SECONDS > IMPORT_TIME_BUDGET_SECONDS:
+    logger.warning(f"Add-on took {IMPORT_SECONDS * 1000:.1f}ms to import, "
+                   f"over the {IMPORT_TIME_BUDGET_SECONDS * 1000:.0f}ms budget")
+else:
+    logger.info(f"Add-on imported in {IMPORT_SECONDS * 1000:.1f}ms")
+
+OPENAI_DEFAULT_MODEL = "text-davinci-003"
+OPENAI_MAX_TOKENS = 4096
+OPENAI_MAX_OUTPUT_TOKENS = 256
+# Highlights sent for completion before their notes are added
+GENERATION_CHUNK_SIZE = 100
+# Output tokens reserved per card when several highlights share a request
+PACKED_OUTPUT_TOKENS_PER_CARD = 128
+
+note_index = None
+
+
+def get_note_index():
+    """The note index of the open profile.
+
+    Opened on first use rather than on import, so nothing is created in
+    user_files before a sync needs it, and reopened when the profile changes.
+    """
+    global note_index
+    path = os.path.join(NOTE_INDEX_DIR, f"{mw.pm.name}.sqlite3")
+    if note_index is None or note_index.path != path:
+        if note_index is not None:
+            note_index.close()
+        note_index = NoteIndex(path).set_parent_logger(logger)
+    return note_index
+
+def get_config():
+    # Read on every sync so config changes apply without restarting Anki
+    return mw.addonManager.getConfig(ADDON_NAME)
+
+def setup_openai(config):
+    openai.api_key = config["openai_api_key"]
+    openai.api_base = config.get("openai_base_url", "https://oai.hconeai.com/v1")  # Helicone for stats
+
+# TODO: Allow these parameters to be customized in advanced menu
+def make_completion_engine(config):
+    return CompletionEngine(
+        model=OPENAI_DEFAULT_MODEL,
+        max_output_tokens=OPENAI_MAX_OUTPUT_TOKENS,
+        temperature=0.5,
+        top_p=1,
+        max_concurrency=config.get("openai_max_concurrency", 8),
+        requests_per_minute=config.get("openai_requests_per_minute", 3000),
+        tokens_per_minute=config.get("openai_tokens_per_minute", 250000),
+        cache=CompletionCache(
+            COMPLETION_CACHE_FILE,
+            max_bytes=config.get("completion_cache_max_mb", 64) * 1024 * 1024,
+            max_age_days=config.get("completion_cache_max_age_days", 180),
+        ).set_parent_logger(logger),
+    ).set_parent_logger(logger)
+
+def get_ai_flashcards(docs, completion_engine, config, metrics=None):
+    # TODO: give pos/neg examples of what it gives me but what I actually want
+    # TODO: Try using Curie / Davinci with fine-tuning
+    # TODO: Handle list/composite highlights
+    # TODO: Let them be bad but let user re-gen it with a prompt. Save prompt
+    # Pack several highlights of a document into one request, up to a token budget
+    # covering the prompt and the expected cards
+    if config.get("prompt_packing", True):
+        batches = [
+            batch for doc in docs
+            for batch in pack_highlights(doc.highlights,
+                                         token_budget=config.get("prompt_packing_token_budget", 3072),
+                                         output_tokens_per_card=PACKED_OUTPUT_TOKENS_PER_CARD,
+                                         count_tokens=lambda text: count_tokens(text, OPENAI_DEFAULT_MODEL))
+        ]
+    else:
+        batches = [[h] for doc in docs for h in doc.highlights]
+    prompts = [
+        PROMPT_TEMPLATE.format(batch[0].text) if len(batch) == 1 else render_packed_prompt(batch)
+        for batch in batches
+    ]
+    max_tokens = [
+        OPENAI_MAX_OUTPUT_TOKENS if len(batch) == 1 else len(batch) * PACKED_OUTPUT_TOKENS_PER_CARD
+        for batch in batches
+    ]
+    metrics = metrics or SyncMetrics()
+    flashcards = []
+    unpacked = []
+    responses = completion_engine.complete_many(prompts, max_tokens)
+    with metrics.span("parse_completions", batches=len(batches)):
+        for batch, prompt, batch_max_tokens, response in zip(batches, prompts, max_tokens, responses):
+            if isinstance(response, openai.error.InvalidRequestError) and len(batch) > 1:
+                # e.g. the token count estimate was off and the batch overflowed the context
+                unpacked.extend(batch)
+                continue
+            if isinstance(response, Exception):
+                # Already logged by the completion engine
+                continue
+            if len(batch) == 1:
+                flashcard = make_flashcard(batch[0], response)
+                if flashcard:
+                    flashcards.append(flashcard)
+                else:
+                    completion_engine.discard(prompt, batch_max_tokens)
+                continue
+            try:
+                flashcards.extend(make_packed_flashcards(batch, response))
+            except ValueError as e:
+                logger.warning(f"Falling back to one request per highlight for a batch of {len(batch)}: {e}")
+                completion_engine.discard(prompt, batch_max_tokens)
+                unpacked.extend(batch)
+    if unpacked:
+        metrics.increment("unpacked_highlights", len(unpacked))
+        prompts = [PROMPT_TEMPLATE.format(h.text) for h in unpacked]
+        responses = completion_engine.complete_many(prompts)
+        with metrics.span("parse_completions", batches=len(unpacked)):
+            for h, prompt, response in zip(unpacked, prompts, responses):
+                if isinstance(response, Exception):
+                    continue
+                flashcard = make_flashcard(h, response)
+                if flashcard:
+                    flashcards.append(flashcard)
+                else:
+                    completion_engine.discard(prompt)
+    metrics.increment("flashcards_generated", len(flashcards))
+    return flashcards
+
+def make_flashcard(highlight, openai_response):
+    completion = openai_response.choices[0].text
+    card = parse_card(completion)
+    if card is None:
+        logger.warning(f"Couldn't parse a flashcard for highlight {highlight.id}: {completion!r}")
+        return None
+    question, answer = card
+    return Flashcard(highlight_id=highlight.id,
+                     text_hash=text_hash(highlight.text),
+                     question=question,
+                     answer=answer)
+
+def make_packed_flashcards(highlights, openai_response):
+    """Split a packed completion into one flashcard per highlight, raising ValueError if it can't."""
+    choice = openai_response.choices[0]
+    if choice.finish_reason == "length":
+        raise ValueError("Packed completion was cut off")
+    cards = parse_packed_completion(choice.text, len(highlights))
+    return [
+        Flashcard(highlight_id=h.id, text_hash=text_hash(h.text), question=question, answer=answer)
+        for h, (question, answer) in zip(highlights, cards)
+    ]
+
+def sync_highlights(config, completion_engine, metrics, write, cancelled=None):
+    """Pass flashcards for the new and edited Readwise highlights to `write`, one chunk at a time.
+
+    Runs on a background thread without the collection; `write` is responsible
+    for getting to the main thread.
+    Stops before the next chunk once the `cancelled` event is set.
+    """
+    duplicate_filter = make_duplicate_filter(config, completion_engine)
+    readwise_pages = iter_filtered_readwise_highlights(config, metrics)
+    # Closing the pages early leaves the highlight store's watermark where it
+    # was, so a cancelled export is fetched again next time
+    with contextlib.closing(readwise_pages):
+        # Only new or edited highlights need flashcards
+        pages = (get_note_index().filter_documents(page) for page in readwise_pages)
+        for docs in chunk_documents(pages):
+            if cancelled and cancelled.is_set():
+                logger.info("Sync cancelled")
+                metrics.increment("cancelled")
+                break
+            if duplicate_filter:
+                docs = duplicate_filter.filter_documents(docs)
+            num_highlights = sum(len(d.highlights) for d in docs)
+            metrics.increment("highlights_to_generate", num_highlights)
+            with metrics.span("generate_chunk", highlights=num_highlights):
+                flashcards = get_ai_flashcards(docs, completion_engine, config, metrics)
+            write(flashcards)
+    if duplicate_filter:
+        metrics.increment("near_duplicates_dropped", duplicate_filter.num_dropped)
+
+def make_duplicate_filter(config, completion_engine):
+    # Highlights at least this similar to one that already has a card are skipped.
+    # Needs numpy, which Anki doesn't ship, so it's off without it.
+    threshold = config.get("dedup_similarity_threshold", 0.95)
+    if not threshold:
+        return None
+    if not HAS_NUMPY:
+        logger.info("Not filtering near-duplicate highlights, that needs numpy")
+        return None
+    return DuplicateFilter(
+        EmbeddingIndex(EMBEDDINGS_DIR),
+        embed=lambda texts: completion_engine.embed_many(texts, DEFAULT_EMBEDDING_MODEL),
+        note_index=get_note_index(),
+        lookup_highlights=lookup_stored_highlights,
+        threshold=threshold,
+    ).set_parent_logger(logger)
+
+def lookup_stored_highlights(highlight_ids):
+    # Opened here since the store can't be shared between threads
+    with contextlib.closing(HighlightStore(HIGHLIGHT_STORE_FILE).set_parent_logger(logger)) as store:
+        return store.highlights(highlight_ids)
+
+def filter_documents(docs):
+    sources_to_ignore = {
+        # Things that we didn't highlight. Readwise adds
+        # supplemental popular highlights from things we've read,
+        # which is nice, but I think people should be intentional
+        # about what they memorize. Maybe it makes sense to allow
+        # these since they are often high-quality notes, and just
+        # delete them when you see them (in whatever application
+        # you make).
+        "supplemental",
+        # Things that aren't highlightable (audio/video)
+        # If you take good notes (or can filter the good notes),
+        # or can use the timestamp to transcribe the media, you might
+        # want to add these back.
+        "podcast",
+        "airr",
+        # Twitter highlights are kinda noisy. For me they are usually
+        # the first Tweet in a bookmarked threads, and only some of that
+        # is stuff I'd want to memorize.
+        "twitter",
+    }
+    filtered_highlights = [
+        d for d in docs
+        if d.source not in sources_to_ignore
+        # Only fetch highlights
+        # TODO: Add support for x["document_note"]
+        if d.highlights
+    ]
+    return filtered_highlights
+
+def iter_filtered_readwise_highlights(config, metrics=None):
+    """Yield pages of documents, starting with the changes as they stream in from Readwise."""
+    readwise_client = ReadwiseClient(api_key=config["readwise_api_key"]).set_parent_logger(logger) \
+        .set_base_url(config.get("readwise_base_url", READWISE_BASE_URL)) \
+        .set_metrics(metrics or SyncMetrics())
+    with contextlib.closing(HighlightStore(HIGHLIGHT_STORE_FILE).set_parent_logger(logger)) as store:
+        synced_ids = set()
+        for page in store.iter_sync(readwise_client):
+            synced_ids.update(d.user_book_id for d in page)
+            yield filter_documents(page)
+        # Then the rest of the library that didn't change since the last sync
+        for page in store.iter_documents(exclude=synced_ids):
+            yield filter_documents(page)
+
+def get_filtered_readwise_highlights(config, metrics=None):
+    return [d for page in iter_filtered_readwise_highlights(config, metrics) for d in page]
+
+def chunk_documents(pages, max_highlights=GENERATION_CHUNK_SIZE):
+    """Regroup pages of documents into chunks of about `max_highlights` highlights."""
+    chunk, num_highlights = [], 0
+    for page in pages:
+        for doc in page:
+            chunk.append(doc)
+            num_highlights += len(doc.highlights)
+            if num_highlights >= max_highlights:
+                yield chunk
+                chunk, num_highlights = [], 0
+    if chunk:
+        yield chunk
+
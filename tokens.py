@@ -0,0 +1,45 @@
+import math
+import re
+from functools import lru_cache
+
+# tiktoken isn't vendored because it ships a compiled extension. Without it we
+# fall back to an estimate based on the GPT-2 pre-tokenizer.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# The GPT-2/GPT-3 pre-tokenization pattern, with \p{L}/\p{N} spelled in
+# terms of the stdlib `re` classes. Pieces are then split further by BPE.
+PRETOKENIZE_RE = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+""")
+# Common words are a single BPE token; longer or rarer ones get split into
+# pieces of about this many characters.
+CHARS_PER_BPE_PIECE = 4
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("p50k_base")
+
+
+def _estimate_tokens(text: str) -> int:
+    num_tokens = 0
+    for piece in PRETOKENIZE_RE.findall(text):
+        piece = piece.strip() or piece
+        if len(piece) <= CHARS_PER_BPE_PIECE + 2 and piece.isascii():
+            num_tokens += 1
+        elif piece.isascii():
+            num_tokens += math.ceil(len(piece) / CHARS_PER_BPE_PIECE)
+        else:
+            # Non-ASCII characters often take a token (or more) each
+            num_tokens += len(piece)
+    return num_tokens
+
+
+def count_tokens(text: str, model: str="text-davinci-003") -> int:
+    if tiktoken:
+        return len(_encoding(model).encode(text))
+    return _estimate_tokens(text)